@@ -0,0 +1,77 @@
+# embedding_model.py
+import os
+import platform
+import sys
+
+# Thread pools are sized when torch is imported, so configure them first.
+# This module must be imported before sentence_transformers or torch.
+# By default the CPUs are split evenly between the server's worker processes.
+MCP_WORKERS = max(1, int(os.environ.get('MCP_WORKERS', '1')))
+SBERT_THREADS = int(os.environ.get('SBERT_THREADS', max(1, (os.cpu_count() or 1) // MCP_WORKERS)))
+os.environ['OMP_NUM_THREADS'] = str(SBERT_THREADS)
+os.environ['MKL_NUM_THREADS'] = str(SBERT_THREADS)
+
+import torch
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+torch.set_num_threads(SBERT_THREADS)
+torch.set_num_interop_threads(1)
+
+MODEL_NAME = 'paraphrase-multilingual-MiniLM-L12-v2'
+
+# Corpora below this size are searched exactly over the saved embeddings by the
+# server; vector_db_ingest.py stores larger ones as IVF-PQ
+FLAT_SEARCH_MAX_CHUNKS = 10000
+
+# Dynamic int8 quantization configs published for MODEL_NAME, keyed by CPU family
+QUANTIZATION_CONFIG = 'arm64' if platform.machine().lower() in ('arm64', 'aarch64') else 'avx512'
+
+def load_model():
+    """Loads the embedding model shared by ingestion and the server.
+
+    SBERT_MODEL overrides the model name or points at a directory written by
+    `python embedding_model.py <onnx|model2vec> <out_dir>`. SBERT_BACKEND selects
+    'onnx' (default, int8-quantized), 'torch', or 'model2vec' for a distilled
+    static-embedding model whose encode() is compatible with SentenceTransformer.
+    """
+    model_name = os.environ.get('SBERT_MODEL', MODEL_NAME)
+    backend = os.environ.get('SBERT_BACKEND', 'onnx')
+    if backend == 'model2vec':
+        if 'SBERT_MODEL' not in os.environ:
+            raise ValueError("SBERT_BACKEND=model2vec requires SBERT_MODEL to point at a model2vec model, "
+                             "e.g. one created by `python embedding_model.py model2vec <out_dir>`")
+        from model2vec import StaticModel
+        # StaticModel ignores normalize_embeddings, so normalize in the model itself
+        return StaticModel.from_pretrained(model_name, normalize=True)
+    if backend == 'onnx':
+        import onnxruntime
+        onnx_file = os.environ.get('SBERT_ONNX_FILE', f'onnx/model_qint8_{QUANTIZATION_CONFIG}.onnx')
+        # onnxruntime has its own thread pools, unaffected by torch or OMP/MKL settings
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = SBERT_THREADS
+        session_options.inter_op_num_threads = 1
+        return SentenceTransformer(model_name, backend='onnx',
+                                   model_kwargs={'file_name': onnx_file, 'session_options': session_options})
+    return SentenceTransformer(model_name)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] not in ('onnx', 'model2vec'):
+        print("Usage: python embedding_model.py <onnx|model2vec> <output_dir>", file=sys.stderr)
+        sys.exit(1)
+
+    out_dir = sys.argv[2]
+    if sys.argv[1] == 'onnx':
+        # Export the model to ONNX once, then add the int8 variant next to it
+        model = SentenceTransformer(MODEL_NAME, backend='onnx')
+        model.save_pretrained(out_dir)
+        export_dynamic_quantized_onnx_model(model, QUANTIZATION_CONFIG, out_dir)
+        print(f"Exported quantized ONNX model ({QUANTIZATION_CONFIG}) to {out_dir}")
+    else:
+        # Distill the transformer into static token embeddings (lookup + mean pooling)
+        from model2vec.distill import distill
+        # Unlike SentenceTransformer, model2vec needs the full Hub id including the namespace
+        # Keep the teacher's 384 dimensions (model2vec's default PCA reduces to 256),
+        # so the embeddings match the shapes the index settings are tuned for
+        static_model = distill(model_name=f'sentence-transformers/{MODEL_NAME}', pca_dims=384)
+        static_model.save_pretrained(out_dir)
+        print(f"Distilled model2vec static model to {out_dir}")
@@ -1,5 +1,8 @@
+import asyncio
 import requests
 import json
+import sys
+import time
 
 SERVER_URL = "http://localhost:8000/mcp"  # Adjust if your server runs on a different port/path
 
@@ -12,16 +15,17 @@ QUERY_PAYLOAD = {
     "id": "q1"
 }
 
+# Reused across calls so keep-alive connections are not re-established per query
+SESSION = requests.Session()
+SESSION.headers['Content-Type'] = 'application/json'
+
 def send_query():
     """Sends the predefined query to the MCP server and prints the response."""
-    headers = {
-        "Content-Type": "application/json"
-    }
     try:
         print(f"Sending query to {SERVER_URL}...")
         print(f"Payload: {json.dumps(QUERY_PAYLOAD, indent=2)}\n")
         
-        response = requests.post(SERVER_URL, json=QUERY_PAYLOAD, headers=headers)
+        response = SESSION.post(SERVER_URL, json=QUERY_PAYLOAD)
         
         print(f"Response Status Code: {response.status_code}\n")
         
@@ -44,5 +48,23 @@ def send_query():
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
 
+async def run_load_test(num_queries: int):
+    """Sends num_queries copies of the predefined query concurrently and prints the throughput."""
+    import httpx  # Only needed for load tests
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=64), timeout=30.0) as client:
+        start = time.perf_counter()
+        responses = await asyncio.gather(
+            *(client.post(SERVER_URL, json={**QUERY_PAYLOAD, "id": f"q{i}"}) for i in range(num_queries))
+        )
+        elapsed = time.perf_counter() - start
+    # Query errors come back as HTTP 200 with "error" set, so check the body as well
+    failed = sum(1 for response in responses
+                 if response.status_code != 200 or response.json().get("error") is not None)
+    print(f"Sent {num_queries} queries in {elapsed:.2f}s ({num_queries / elapsed:.1f} queries/s), {failed} failed")
+
 if __name__ == "__main__":
-    send_query()
+    if len(sys.argv) == 3 and sys.argv[1] == "--load":
+        asyncio.run(run_load_test(int(sys.argv[2])))
+    else:
+        send_query()
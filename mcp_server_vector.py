@@ -1,121 +1,361 @@
 # mcp_server_vector.py
-import json
+import asyncio
+import multiprocessing
+import os
+import queue
 import sys
-from dataclasses import dataclass, asdict
-from typing import Dict, Any, List, Optional
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List
+from embedding_model import FLAT_SEARCH_MAX_CHUNKS, MODEL_NAME, load_model
 import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xxhash
 from sentence_transformers import SentenceTransformer
-import faiss
-from http.server import HTTPServer, BaseHTTPRequestHandler
+try:
+    import faiss
+except ImportError:
+    faiss = None  # Not needed when small corpora are searched with FlatIndex
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+from aiohttp import web
+try:
+    import uvloop
+except ImportError:
+    uvloop = None  # Not available on Windows; falls back to the default asyncio loop
 
-@dataclass
-class MCPRequest:
-    name: str
-    input: Dict[str, Any]
-    id: str
+# Concurrent queries are coalesced into batches of up to MAX_BATCH, waiting at most MAX_WAIT_MS
+MAX_BATCH = 32
+MAX_WAIT_MS = 5
 
-@dataclass
-class MCPResponse:
-    id: str
-    content: Dict[str, Any]
-    error: Optional[str] = None
+# Number of recent query embeddings kept to skip the model on repeated queries
+ENCODE_CACHE_SIZE = 1024
+
+# Serialized responses kept for byte-identical repeated requests, bounded by total
+# size; responses larger than RESPONSE_CACHE_MAX_ENTRY_BYTES (large top_k) are not cached
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+
+def configure_search_params(index: 'faiss.Index'):
+    # Query-time knobs for the index types built by vector_db_ingest.py
+    if hasattr(index, 'nprobe'):
+        index.nprobe = 16
+
+class FlatIndex:
+    """Exact cosine search over the normalized embedding matrix saved at ingest.
+
+    Uses SimSIMD's float16 kernels when installed, otherwise a NumPy (BLAS)
+    matrix product. Mirrors the faiss.Index.search() interface so VectorDB can use either.
+    """
+    def __init__(self, embeddings: np.ndarray):
+        if simsimd is not None:
+            self.embeddings = embeddings
+        else:
+            # Contiguous float32 copy so scoring is a single SGEMM/SGEMV call
+            self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.ntotal = len(embeddings)
+
+    def search(self, queries: np.ndarray, top_k: int):
+        if simsimd is not None:
+            # cdist returns cosine distances; convert back to similarities
+            distances = simsimd.cdist(queries.astype(np.float16), self.embeddings, metric='cosine')
+            scores = 1.0 - np.asarray(distances, dtype=np.float32)
+        else:
+            # Both sides are normalized, so inner products are cosine similarities
+            scores = queries @ self.embeddings.T
+        # Partial selection of the top k, then sort only those k
+        k = max(0, min(top_k, self.ntotal))
+        if k == 0:
+            return np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1)
+        return np.take_along_axis(candidate_scores, order, axis=1), np.take_along_axis(candidates, order, axis=1)
+
+# Faiss index file type codes (the first four bytes of the file)
+FLAT_CODES_FOURCCS = {b'IxFI', b'IxF2'}  # IndexFlatIP / IndexFlatL2
+IVF_ARRAY_LISTS_FOURCCS = {b'IwFl', b'IwPQ'}  # IndexIVFFlat / IndexIVFPQ
+
+def index_io_flags(path: str) -> int:
+    # Each index type needs its own mmap flag: IO_FLAG_MMAP maps the array inverted
+    # lists of IVFFlat/IVFPQ, IO_FLAG_MMAP_IFC (newer faiss) maps flat code storage,
+    # and the two cannot be combined. Other types, such as IVFPQFastScan with its
+    # block inverted lists, cannot be mapped and are read onto the heap.
+    with open(path, 'rb') as f:
+        fourcc = f.read(4)
+    if fourcc in FLAT_CODES_FOURCCS and hasattr(faiss, 'IO_FLAG_MMAP_IFC'):
+        return faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+    if fourcc in IVF_ARRAY_LISTS_FOURCCS:
+        return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return 0
+
+def prefetch_file(path: str):
+    # Ask the kernel to start reading the file into the page cache in the background
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+def load_index(faiss_index_path: str):
+    prefetch = os.environ.get('MCP_PREFETCH_INDEX') == '1'
+    embeddings_path = faiss_index_path.replace('.faiss', '_embeddings.npy')
+    if os.path.exists(embeddings_path):
+        embeddings = np.load(embeddings_path, mmap_mode='r')
+        if len(embeddings) < FLAT_SEARCH_MAX_CHUNKS:
+            print(f"Using {'SimSIMD' if simsimd is not None else 'NumPy'} flat search over {embeddings_path}...")
+            if prefetch:
+                prefetch_file(embeddings_path)
+            return FlatIndex(embeddings)
+    if faiss is None:
+        print(f"Error: faiss is not installed. Install faiss-cpu to serve corpora of {FLAT_SEARCH_MAX_CHUNKS} chunks or more.")
+        sys.exit(1)
+    print("Loading FAISS index...")
+    if prefetch:
+        prefetch_file(faiss_index_path)
+    index = faiss.read_index(faiss_index_path, index_io_flags(faiss_index_path))
+    configure_search_params(index)
+    return index
 
 class VectorDB:
-    def __init__(self, model: SentenceTransformer, index: faiss.Index, chunks_with_ids: List[Dict[str, Any]]):
+    def __init__(self, model: SentenceTransformer, index: Any, chunks: pa.Table):
         self.model = model
         self.index = index
-        self.chunks_with_ids = chunks_with_ids
-        # Create a mapping from original_id to chunk text for quick lookup
-        self.id_to_chunk_text = {item['original_id']: item['text'] for item in self.chunks_with_ids}
+        # Column lookups by position; no per-chunk Python objects are created up front
+        self.ids = chunks.column('original_id')
+        self.texts = chunks.column('text')
+        self.num_chunks = chunks.num_rows
+        # LRU of normalized query embeddings, most recently used last
+        self._enc_cache: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+        self._enc_lock = threading.Lock()
+
+    def encode(self, queries: List[str]) -> np.ndarray:
+        with self._enc_lock:
+            missing = [query for query in dict.fromkeys(queries) if query not in self._enc_cache]
+            if missing:
+                embeddings = self.model.encode(missing, batch_size=MAX_BATCH, convert_to_numpy=True)
+                # MiniLM already returns contiguous float32, so these are no-ops in the common case
+                if embeddings.dtype != np.float32:
+                    embeddings = embeddings.astype(np.float32, copy=False)
+                if not embeddings.flags['C_CONTIGUOUS']:
+                    embeddings = np.ascontiguousarray(embeddings)
+                # An all-zero embedding (e.g. model2vec on "") would otherwise divide by zero
+                embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+                for query, embedding in zip(missing, embeddings):
+                    # Copy so the cache does not keep the whole batch matrix alive
+                    self._enc_cache[query] = embedding.copy()
+            for query in queries:
+                self._enc_cache.move_to_end(query)
+            query_embeddings = np.stack([self._enc_cache[query] for query in queries])
+            while len(self._enc_cache) > ENCODE_CACHE_SIZE:
+                self._enc_cache.popitem(last=False)
+        return query_embeddings
 
     def search(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
-        query_embedding = self.model.encode([query])
-        distances, indices = self.index.search(np.array(query_embedding).astype('float32'), top_k)
-        
-        results = []
-        for i, (idx, distance) in enumerate(zip(indices[0], distances[0])):
-            if idx >= 0 and idx < len(self.chunks_with_ids):
-                # The 'idx' from FAISS is the position in the array used for self.index.add()
-                # This should correspond to the order in self.chunks_with_ids if ingested sequentially.
-                original_id = self.chunks_with_ids[idx].get('original_id', f"unknown_id_{idx}")
-                text_content = self.id_to_chunk_text.get(original_id, "Content not found")
-                results.append({
-                    "original_id": original_id,
-                    "text": text_content,
-                    "score": float(1.0 / (1.0 + distance)) # Example score, can be adjusted
-                })
-            else:
-                # Handle cases where idx might be out of bounds or -1 (no result)
-                print(f"Warning: FAISS index {idx} out of bounds or invalid.")
-        return results
+        return self.search_batch([query], [top_k])[0]
+
+    def search_batch(self, queries: List[str], top_ks: List[int]) -> List[List[Dict[str, Any]]]:
+        # One forward pass for the uncached queries and one index search for all of them
+        query_embeddings = self.encode(queries)
+        distances, indices = self.index.search(query_embeddings, max(top_ks))
+
+        batch_results = []
+        for row_indices, row_distances, top_k in zip(indices, distances, top_ks):
+            results = []
+            # Hits are sorted, so only this query's first top_k are turned into results;
+            # tolist() yields plain ints and floats instead of boxing numpy scalars per hit
+            for idx, distance in zip(row_indices[:top_k].tolist(), row_distances[:top_k].tolist()):
+                if idx >= 0 and idx < self.num_chunks:
+                    # The 'idx' from FAISS is the position in the array used for self.index.add()
+                    # This corresponds to the row order of the chunks table as ingested sequentially.
+                    results.append({
+                        "original_id": self.ids[idx].as_py(),
+                        "text": self.texts[idx].as_py(),
+                        "score": distance # Cosine similarity, higher is better
+                    })
+                else:
+                    # Handle cases where idx might be out of bounds or -1 (no result)
+                    print(f"Warning: FAISS index {idx} out of bounds or invalid.")
+            batch_results.append(results)
+        return batch_results
+
+class QueryBatcher:
+    """Coalesces queries from concurrent requests into a single VectorDB.search_batch() call."""
+    def __init__(self, vdb: VectorDB, max_batch: int = MAX_BATCH, max_wait_ms: float = MAX_WAIT_MS):
+        self.vdb = vdb
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def search(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
+        event = threading.Event()
+        slot: Dict[str, Any] = {}
+        self.queue.put((query, top_k, event, slot))
+        event.wait()
+        if "error" in slot:
+            raise slot["error"]
+        return slot["results"]
+
+    def _next_batch(self) -> List[tuple]:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _search(self, batch: List[tuple]):
+        # Search once with the largest top_k; each query only materializes its own top_k hits
+        batch_results = self.vdb.search_batch([query for query, _, _, _ in batch],
+                                              [top_k for _, top_k, _, _ in batch])
+        for (_, _, _, slot), results in zip(batch, batch_results):
+            slot["results"] = results
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._search(batch)
+            except Exception:
+                # Retry one at a time so an error only reaches the request that caused it
+                for item in batch:
+                    item[3].pop("results", None)
+                    try:
+                        self._search([item])
+                    except Exception as e:
+                        item[3]["error"] = e
+            finally:
+                for _, _, event, _ in batch:
+                    event.set()
 
 class MCPServer:
-    def __init__(self, model: SentenceTransformer, index: faiss.Index, chunks_with_ids: List[Dict[str, Any]], handler_class, port: int):
-        self.vdb = VectorDB(model, index, chunks_with_ids)
+    def __init__(self, model: SentenceTransformer, index: Any, chunks: pa.Table, port: int, reuse_port: bool = False):
+        self.vdb = VectorDB(model, index, chunks)
+        self.batcher = QueryBatcher(self.vdb)
         self.handlers = {"query": self.handle_query}
-        self.handler_class = handler_class
         self.port = port
+        # Lets several worker processes bind the same port; the kernel spreads connections across them
+        self.reuse_port = reuse_port
+        # Blocking encode/search runs here so it never stalls the event loop;
+        # one thread per batch slot lets concurrent queries meet in the batcher
+        self.executor = ThreadPoolExecutor(max_workers=MAX_BATCH)
+        # LRU of serialized responses keyed by the xxh3 hash of the raw request body.
+        # Only touched from the event loop thread, so it needs no lock.
+        self.response_cache: 'OrderedDict[int, bytes]' = OrderedDict()
+        self.response_cache_bytes = 0
     
     def handle_query(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
         query = input_data.get("query", "")
         top_k = input_data.get("top_k", 3)
+        # Reject bad input here so it cannot fail the other queries in its batch
+        if not isinstance(query, str):
+            raise ValueError("'query' must be a string")
+        if isinstance(top_k, bool) or not isinstance(top_k, int) or top_k <= 0:
+            raise ValueError("'top_k' must be a positive integer")
         # The search method now returns richer results including text
-        return {"results": self.vdb.search(query, top_k), "query_received": query}
+        return {"results": self.batcher.search(query, top_k), "query_received": query}
     
     def process_message(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        # Responses are built as plain dicts with the keys id, content and error
         try:
-            request = MCPRequest(**message)
-            handler = self.handlers.get(request.name)
+            request_id = message["id"]
+            name = message["name"]
+            handler = self.handlers.get(name)
             if not handler:
-                return asdict(MCPResponse(id=request.id, error=f"Invalid handler: {request.name}"))
+                return {"id": request_id, "content": None, "error": f"Invalid handler: {name}"}
             
-            result = handler(request.input)
-            return asdict(MCPResponse(id=request.id, content=result))
+            result = handler(message["input"])
+            return {"id": request_id, "content": result, "error": None}
         
         except Exception as e:
-            return asdict(MCPResponse(id=message.get("id", ""), error=f"Error: {str(e)}"))
+            return {"id": message.get("id", ""), "content": None, "error": f"Error: {str(e)}"}
+
+    @staticmethod
+    def json_response(data: Any, status: int = 200) -> web.Response:
+        # orjson encodes straight to bytes; a bytes body is sent with an explicit Content-Length
+        body = data if isinstance(data, bytes) else orjson.dumps(data)
+        return web.Response(body=body, status=status, content_type='application/json')
+
+    async def handle_post(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        cache_key = xxhash.xxh3_64_intdigest(body)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            self.response_cache.move_to_end(cache_key)
+            return self.json_response(cached)
+        try:
+            message = orjson.loads(body)
+        except orjson.JSONDecodeError as e:
+            return self.json_response({"id": "unknown", "error": f"Bad Request: Invalid JSON - {e}"}, status=400)
+        try:
+            loop = asyncio.get_running_loop()
+            response_data = await loop.run_in_executor(self.executor, self.process_message, message)
+            response_body = orjson.dumps(response_data)
+            # Errors are not cached so that transient failures are retried
+            if response_data.get("error") is None and len(response_body) <= RESPONSE_CACHE_MAX_ENTRY_BYTES:
+                previous = self.response_cache.pop(cache_key, None)
+                if previous is not None:
+                    self.response_cache_bytes -= len(previous)
+                self.response_cache[cache_key] = response_body
+                self.response_cache_bytes += len(response_body)
+                while self.response_cache_bytes > RESPONSE_CACHE_MAX_BYTES:
+                    _, evicted = self.response_cache.popitem(last=False)
+                    self.response_cache_bytes -= len(evicted)
+            return self.json_response(response_body)
+        except Exception as e:
+            error_response = {"id": message.get("id") if isinstance(message, dict) else "unknown", "error": f"Internal Server Error: {e}"}
+            return self.json_response(error_response, status=500)
 
     def run(self):
-        server_address = ('', self.port)
-        httpd = HTTPServer(server_address, self.handler_class)
+        if uvloop is not None:
+            uvloop.install()
+        app = web.Application()
+        app.router.add_post('/mcp', self.handle_post)
         print(f"MCP Vector Server started on port {self.port}...")
         try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
+            # run_app handles KeyboardInterrupt and returns after a graceful shutdown
+            web.run_app(app, port=self.port, print=None, reuse_port=self.reuse_port or None)
             print("MCP Vector Server stopped.")
         finally:
-            httpd.server_close()
+            self.executor.shutdown(wait=False)
             print("Cleaning up...")
 
-class CustomRequestHandler(BaseHTTPRequestHandler):
-    # This class will be assigned the mcp_server_instance at runtime
-    mcp_server_instance: 'MCPServer' 
+def serve(faiss_index_path: str, port: int, reuse_port: bool = False):
+    print(f"Loading sentence transformer model ({MODEL_NAME})...")
+    # Load model once per worker process
+    sbert_model = load_model()
+    index = load_index(faiss_index_path)
 
-    def do_POST(self):
-        try:
-            content_length = int(self.headers['Content-Length'])
-            body = self.rfile.read(content_length)
-            message = json.loads(body.decode('utf-8')) # Ensure decoding
-            
-            # Access the process_message method from the mcp_server_instance
-            response_data = self.mcp_server_instance.process_message(message)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(response_data).encode('utf-8'))
-        except json.JSONDecodeError as e:
-            self.send_response(400)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            error_response = {"id": message.get("id") if isinstance(message, dict) else "unknown", "error": f"Bad Request: Invalid JSON - {e}"}
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
-        except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            error_response = {"id": message.get("id") if isinstance(message, dict) else "unknown", "error": f"Internal Server Error: {e}"}
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
+    # Load the chunks table from the Parquet file created during ingestion
+    chunks_parquet_path = faiss_index_path.replace('.faiss', '_chunks.parquet')
+    try:
+        chunks = pq.read_table(chunks_parquet_path, memory_map=True)
+        print(f"Successfully loaded {chunks.num_rows} chunks from {chunks_parquet_path}")
+    except FileNotFoundError:
+        print(f"Error: Chunks Parquet file not found at {chunks_parquet_path}. Ensure it was created by vector_db_ingest.py.")
+        sys.exit(1)
+    except pa.ArrowInvalid as e:
+        print(f"Error reading Parquet from {chunks_parquet_path}: {e}")
+        sys.exit(1)
+
+    # Create the MCPServer instance, passing the loaded model, index, chunks, and port
+    mcp_server = MCPServer(sbert_model, index, chunks, port, reuse_port)
+    
+    mcp_server.run()
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
@@ -124,30 +364,25 @@ if __name__ == '__main__':
 
     FAISS_INDEX_PATH = sys.argv[1]
     PORT = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    WORKERS = int(os.environ.get('MCP_WORKERS', '1'))
 
-    print("Loading sentence transformer model (paraphrase-multilingual-MiniLM-L12-v2)...")
-    # Load model once
-    sbert_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2') 
-    print("Loading FAISS index...")
-    faiss_index = faiss.read_index(FAISS_INDEX_PATH)
-
-    # Load chunks_with_ids from the JSON file created during ingestion
-    chunks_json_path = FAISS_INDEX_PATH.replace('.faiss', '_chunks.json')
-    try:
-        with open(chunks_json_path, 'r', encoding='utf-8') as f:
-            chunks_with_ids = json.load(f)
-        print(f"Successfully loaded {len(chunks_with_ids)} chunks from {chunks_json_path}")
-    except FileNotFoundError:
-        print(f"Error: Chunks JSON file not found at {chunks_json_path}. Ensure it was created by vector_db_ingest.py.")
-        sys.exit(1)
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON from {chunks_json_path}: {e}")
+    if WORKERS > 1 and not sys.platform.startswith('linux'):
+        # Only Linux load-balances connections across SO_REUSEPORT listeners
+        print("Error: MCP_WORKERS > 1 is only supported on Linux.")
         sys.exit(1)
 
-    # Create the MCPServer instance, passing the loaded model, index, chunks, handler, and port
-    mcp_server = MCPServer(sbert_model, faiss_index, chunks_with_ids, CustomRequestHandler, PORT)
-    
-    # Assign the MCPServer instance to the handler class so it can be accessed in do_POST
-    CustomRequestHandler.mcp_server_instance = mcp_server
-    
-    mcp_server.run()
+    if WORKERS <= 1:
+        serve(FAISS_INDEX_PATH, PORT)
+    else:
+        # Each worker loads its own model and index (see load_index for which index
+        # files are shared through mmap); SO_REUSEPORT balances connections between them
+        workers = [multiprocessing.Process(target=serve, args=(FAISS_INDEX_PATH, PORT, True)) for _ in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            # Workers receive the same SIGINT and shut down on their own
+            for worker in workers:
+                worker.join()
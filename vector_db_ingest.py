@@ -1,41 +1,76 @@
 # vector_db_ingest.py
+import re
 import sys
+from collections import deque
+from embedding_model import FLAT_SEARCH_MAX_CHUNKS, load_model
 import numpy as np
-from sentence_transformers import SentenceTransformer
 import faiss
-import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+IVF_NLIST = 256
+PQ_M = 48
+
+def build_index(embeddings: np.ndarray) -> faiss.Index:
+    dimension = embeddings.shape[1]
+    if len(embeddings) < FLAT_SEARCH_MAX_CHUNKS:
+        # The server searches small corpora exactly over the saved embeddings, so an
+        # expensive graph would never be read; a flat index is just a cheap fallback
+        index = faiss.IndexFlatIP(dimension)
+    else:
+        # 4-bit PQ codes enable the FastScan SIMD lookup-table kernels
+        # PQ needs the dimension to split evenly into sub-quantizers
+        pq_m = max(m for m in range(1, PQ_M + 1) if dimension % m == 0)
+        quantizer = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIVFPQFastScan(quantizer, dimension, IVF_NLIST, pq_m, 4, faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+    index.add(embeddings)
+    return index
 
 def create_vector_db(book_path: str, output_index: str, chunk_size: int = 1000, overlap: int = 200):
     # Load and chunk text
     with open(book_path, 'r', encoding='utf-8') as f:
         text = f.read()
     
-    words = text.split()
-    chunks = [' '.join(words[i:i+chunk_size]) 
-             for i in range(0, len(words), chunk_size - overlap)]
+    # Single pass over the words that keeps only the start offsets of windows still
+    # collecting words; each window is sliced out of the text once its last word is seen
+    stride = chunk_size - overlap
+    chunks = []
+    open_starts = deque()
+    last_end = 0
+    for word_index, match in enumerate(re.finditer(r'\S+', text)):
+        if word_index % stride == 0:
+            open_starts.append(match.start())
+        if word_index >= chunk_size - 1 and (word_index - chunk_size + 1) % stride == 0:
+            chunks.append(text[open_starts.popleft():match.end()])
+        last_end = match.end()
+    # Windows that run past the last word end with it
+    chunks.extend(text[start:last_end] for start in open_starts)
     
     # Create embeddings
-    model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
-    embeddings = model.encode(chunks)
+    model = load_model()
+    # Normalized so that inner product equals cosine similarity
+    embeddings = model.encode(chunks, batch_size=64, show_progress_bar=True,
+                              convert_to_numpy=True, normalize_embeddings=True).astype(np.float32, copy=False)
     
     # Create and save FAISS index
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(np.array(embeddings).astype('float32'))
+    index = build_index(embeddings)
     faiss.write_index(index, output_index)
     print(f"Created FAISS index with {len(chunks)} chunks at {output_index}")
 
-    # Prepare chunks with original IDs for saving
-    chunks_with_ids = [
-        {"original_id": f"chunk_{i}", "text": chunk_text} 
-        for i, chunk_text in enumerate(chunks)
-    ]
+    # Save the normalized embeddings for the server's exact flat search on small corpora
+    embeddings_path = output_index.replace('.faiss', '_embeddings.npy')
+    np.save(embeddings_path, embeddings.astype(np.float16))
+    print(f"Saved float16 embeddings to {embeddings_path}")
 
-    # Save chunks to a JSON file
-    chunks_json_path = output_index.replace('.faiss', '_chunks.json')
-    with open(chunks_json_path, 'w', encoding='utf-8') as f_json:
-        json.dump(chunks_with_ids, f_json, ensure_ascii=False, indent=4)
-    print(f"Saved {len(chunks_with_ids)} chunks to {chunks_json_path}")
+    # Save chunks with their original IDs as two Parquet columns, row i matching vector i
+    chunks_table = pa.table({
+        "original_id": [f"chunk_{i}" for i in range(len(chunks))],
+        "text": chunks,
+    })
+    chunks_parquet_path = output_index.replace('.faiss', '_chunks.parquet')
+    pq.write_table(chunks_table, chunks_parquet_path)
+    print(f"Saved {chunks_table.num_rows} chunks to {chunks_parquet_path}")
 
 if __name__ == "__main__":
     if len(sys.argv) != 3: